@@ -0,0 +1,201 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from deezer import Track
+
+from exceptions import DownloaderException, DownloadCancelledException
+from tracer import tracer
+
+logger = logging.getLogger("mp3downloader")
+
+user_prompt_lock = threading.Lock()  # held while a backend asks the user for help, so that one prompt is open at a time
+
+
+class DownloadBackend(ABC):
+    """A source of audio files, e.g. a download site or one of its mirrors. A backend downloads one track at a time."""
+
+    def __init__(self, name, download_dir):
+        self.name = name
+        self.download_dir = download_dir
+        self.lock = threading.Lock()
+        self.waiting_on_user = threading.Event()
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir, exist_ok=True)
+
+    @abstractmethod
+    def download(self, track: Track, format, bitrate, cancelled: threading.Event) -> str:
+        """
+        Downloads the track in the given format to download_dir, and returns the path of the downloaded file.
+        Raises a DownloaderException if the download fails, and a DownloadCancelledException soon after `cancelled`
+        is set. A cancelled download must not leave any file behind in download_dir.
+        """
+        pass
+
+    def is_busy(self):
+        return self.lock.locked()
+
+    @contextmanager
+    def prompting_user(self, cancelled: threading.Event):
+        """
+        Waits for any other backend's prompt to be answered before the user is prompted, and tells the scheduler not to
+        hedge while the user is responding. Raises a DownloadCancelledException instead of prompting if the download
+        has been cancelled in the meantime.
+        """
+        self.waiting_on_user.set()
+        try:
+            with user_prompt_lock:
+                if cancelled.is_set():
+                    raise DownloadCancelledException
+                yield
+        finally:
+            self.waiting_on_user.clear()
+
+    def close(self):
+        pass
+
+
+class LocalDirectoryBackend(DownloadBackend):
+    """
+    Serves tracks from a local directory, in which each file is named after its Deezer track id, e.g. '3135556.flac'
+    or '3135556-320.mp3'. Useful as a stand-in for a download site.
+    """
+
+    def __init__(self, source_dir, download_dir):
+        super().__init__(f"local:{os.path.basename(os.path.normpath(source_dir))}", download_dir)
+        self.source_dir = source_dir
+
+    def download(self, track: Track, format, bitrate, cancelled: threading.Event) -> str:
+        candidates = [f"{track.id}-{bitrate}.{format}", f"{track.id}.{format}"] if bitrate else [f"{track.id}.{format}"]
+        for filename in candidates:
+            source = os.path.join(self.source_dir, filename)
+            if not os.path.exists(source):
+                continue
+            if cancelled.is_set():
+                raise DownloadCancelledException
+            target = os.path.join(self.download_dir, filename)
+            shutil.copyfile(source, f"{target}.part")
+            os.replace(f"{target}.part", target)
+            return target
+        raise DownloaderException(f"Track {track.id} is not available in {self.source_dir}")
+
+
+class HedgedScheduler:
+    """
+    Downloads each track from the first available backend. If that download is slower than usual, the track is also
+    requested from the next backend (a hedged request), and the first download to finish wins while the other one is
+    cancelled. A failed download fails over to the next backend right away.
+    The hedge delay is the `latency_quantile` of recent successful downloads, or `hedge_delay` until enough of them
+    have been observed. The hedge timer is paused while a backend waits on the user, e.g. to solve a CAPTCHA.
+    """
+
+    def __init__(self, backends, hedge_delay=90, latency_quantile=0.9, min_samples=5, history_size=20,
+                 poll_interval=1):
+        if len(backends) == 0:
+            raise DownloaderException("At least one download backend is required")
+        self.backends = list(backends)
+        self.hedge_delay = hedge_delay
+        self.latency_quantile = latency_quantile
+        self.min_samples = min_samples
+        self.poll_interval = poll_interval
+        self.latencies = deque(maxlen=history_size)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix="backend")
+
+    def get_hedge_delay(self):
+        if len(self.latencies) < self.min_samples:
+            return self.hedge_delay
+        return float(np.quantile(self.latencies, self.latency_quantile))
+
+    def download(self, track: Track, format, bitrate) -> str:
+        # idle backends come first, so that a backend still busy with a cancelled download does not hold up this track
+        pending = sorted(self.backends, key=lambda backend: backend.is_busy())
+        running = dict()  # future -> (backend, cancel event)
+        start_time = time.monotonic()
+        hedge_delay = self.get_hedge_delay()
+        next_hedge_time = start_time
+        paused_at = None  # when a running backend started waiting on the user
+        user_time = 0
+
+        while running or pending:
+            now = time.monotonic()
+            waiting_on_user = any(backend.waiting_on_user.is_set() for backend, _ in running.values())
+            if waiting_on_user and paused_at is None:
+                paused_at = now
+            elif not waiting_on_user and paused_at is not None:
+                next_hedge_time += now - paused_at
+                user_time += now - paused_at
+                paused_at = None
+            if pending and (not running or (paused_at is None and now >= next_hedge_time)):
+                backend = pending.pop(0)
+                if running:
+                    logger.info(f"Track {track.id} is slow to download, requesting it from {backend.name} as well")
+                cancelled = threading.Event()
+                future = self.executor.submit(self._run, backend, track, format, bitrate, cancelled)
+                running[future] = (backend, cancelled)
+                next_hedge_time = now + hedge_delay
+                continue
+            if not pending:
+                timeout = None
+            elif paused_at is not None:
+                timeout = self.poll_interval  # to notice when the user is done
+            else:
+                timeout = max(next_hedge_time - now, 0)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                backend, _ = running.pop(future)
+                try:
+                    filepath = future.result()
+                except Exception as e:
+                    logger.warning(f"Could not download track {track.id} from {backend.name}: {e!r}")
+                    next_hedge_time = time.monotonic()
+                    if paused_at is not None:
+                        paused_at = next_hedge_time
+                    continue
+                # the time spent by the user (e.g. solving a CAPTCHA) says nothing about the speed of the backends
+                end_time = time.monotonic()
+                if paused_at is not None:
+                    user_time += end_time - paused_at
+                self.latencies.append(end_time - start_time - user_time)
+                logger.debug(f"Track {track.id} has been downloaded from {backend.name}")
+                self._cancel(running)
+                if any(backend.waiting_on_user.is_set() for backend, _ in running.values()):
+                    # the prompt of a cancelled backend must be answered before the main thread prompts the user again
+                    logger.info(f"Track {track.id} has been downloaded, the open prompt can be dismissed")
+                    with user_prompt_lock:
+                        pass
+                return filepath
+        raise DownloaderException(f"Track {track.id} could not be downloaded from any backend")
+
+    def _run(self, backend, track, format, bitrate, cancelled):
+        with backend.lock:
+            if cancelled.is_set():
+                raise DownloadCancelledException
+            with tracer.span("DownloadBackend.download", track_id=track.id, backend=backend.name):
+                return backend.download(track, format, bitrate, cancelled)
+
+    def _cancel(self, running):
+        def discard_result(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            filepath = future.result()
+            logger.debug(f"Removing '{filepath}', since the track has already been downloaded by another backend")
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+        for future, (backend, cancelled) in running.items():
+            logger.debug(f"Cancelling the download from {backend.name}")
+            cancelled.set()
+            if not future.cancel():
+                future.add_done_callback(discard_result)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for backend in self.backends:
+            backend.close()
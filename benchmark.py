@@ -0,0 +1,213 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import statistics
+import struct
+import tempfile
+import time
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+
+import click
+from tabulate import tabulate
+
+from main import Downloader, slugify
+from tagger import DeezerTagger, Cache
+
+BASELINE_PATH = "benchmark_baseline.json"
+FIXTURE_SIZES_KB = (512, 8192)
+ARTWORK_URL = "https://e-cdns-images.dzcdn.net/images/cover/benchmark/1000x1000-000000-80-0-0.jpg"
+ARTWORK_DIMENSION = 256  # noisy pixels, so the artwork is about 192 KB, like a typical cover_xl
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"  # MPEG-1 layer III, 128 kbps, 44.1 kHz, no padding
+MP3_FRAME_SIZE = 417
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+def generate_artwork(dimension):
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    header = struct.pack(">IIBBBBB", dimension, dimension, 8, 2, 0, 0, 0)  # 8 bit RGB
+    rows = b"".join(b"\x00" + os.urandom(dimension * 3) for _ in range(dimension))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def generate_mp3(path, size_kb):
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    with open(path, "wb") as f:
+        f.write(frame * (size_kb * 1024 // MP3_FRAME_SIZE))
+
+
+def generate_flac(path, size_kb):
+    sample_rate, channels, bits_per_sample = 44100, 2, 16
+    total_samples = size_kb * 1024 // (channels * bits_per_sample // 8)
+    streaminfo = struct.pack(">HH", 4096, 4096) + bytes(6)
+    streaminfo += ((sample_rate << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36)
+                   | total_samples).to_bytes(8, "big")
+    streaminfo += bytes(16)
+    with open(path, "wb") as f:
+        f.write(b"fLaC")
+        f.write(bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo)
+        f.write(bytes(size_kb * 1024))
+
+
+def fake_track(track_id=1):
+    artist = SimpleNamespace(id=1, name="Benchmark Artist")
+    album = SimpleNamespace(id=1, title="Benchmark Album", nb_tracks=12, release_date=datetime.date(2020, 5, 17),
+                            cover_xl=ARTWORK_URL, label="Benchmark Records",
+                            genres=[SimpleNamespace(name="Pop"), SimpleNamespace(name="Rock")])
+    track = SimpleNamespace(id=track_id, title=f"Benchmark Track {track_id}", artist=artist, album=album,
+                            contributors=[artist, SimpleNamespace(id=2, name="Featured Artist")],
+                            track_position=track_id, disk_number=1, isrc=f"USXXX20{track_id:05}")
+    album.tracks = [SimpleNamespace(disk_number=1 + position // 6) for position in range(album.nb_tracks)]
+    return track
+
+
+def offline_tagger():
+    tagger = DeezerTagger()
+    tagger.image_downloader.image_cache.put(ARTWORK_URL, FakeResponse(generate_artwork(ARTWORK_DIMENSION)))
+    return tagger
+
+
+def _written_bytes():
+    """Returns the number of bytes this process has passed to write calls so far, or None if it is unknown"""
+    try:
+        with open("/proc/self/io") as io_stats:
+            for line in io_stats:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(func, iterations, setup=lambda: None):
+    # time is measured without tracemalloc, which slows down Python code considerably, and peak memory in another pass
+    durations = list()
+    written = list()
+    for _ in range(iterations):
+        setup()
+        written_before = _written_bytes()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+        written_after = _written_bytes()
+        if written_before is not None and written_after is not None:
+            written.append(written_after - written_before)
+
+    setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "time_per_op_ms": statistics.median(durations) * 1000,
+        "bytes_written_per_op": statistics.median(written) if written else None,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def bench_tagging(workdir, iterations, sizes_kb):
+    results = dict()
+    tagger = offline_tagger()
+    track = fake_track()
+    for extension, generate in (("mp3", generate_mp3), ("flac", generate_flac)):
+        for size_kb in sizes_kb:
+            fixture = os.path.join(workdir, f"fixture_{size_kb}kb.{extension}")
+            target = os.path.join(workdir, f"target_{size_kb}kb.{extension}")
+            generate(fixture, size_kb)
+            reset = lambda: shutil.copyfile(fixture, target)
+            results[f"tag[{extension},{size_kb}kb]"] = measure(lambda: tagger.tag(target, track), iterations, reset)
+
+            def tag_then_clear():
+                reset()
+                tagger.tag(target, track)
+                tagger.filepath = target
+            results[f"clear_tags[{extension},{size_kb}kb]"] = measure(tagger.clear_tags, iterations, tag_then_clear)
+    return results
+
+
+def bench_cache(iterations):
+    cache = Cache(size=5)
+    for index in range(cache.size):
+        cache.put(f"https://example.com/{index}.jpg", index)
+    hit_key, miss_key = "https://example.com/4.jpg", "https://example.com/missing.jpg"
+    batch = 10000
+    return {
+        "Cache.search[hit] x10000": measure(lambda: [cache.search(hit_key) for _ in range(batch)], iterations),
+        "Cache.search[miss] x10000": measure(lambda: [cache.search(miss_key) for _ in range(batch)], iterations),
+    }
+
+
+def bench_paths(iterations):
+    downloader = Downloader.__new__(Downloader)  # skips __init__, which opens a browser
+    downloader.download_path = tempfile.gettempdir()
+    tracks = [fake_track(track_id) for track_id in range(1, 101)]
+    names = [f"{track.track_position:02} {track.artist.name} - {track.title} (feat. Someone) [Remix]?*"
+             for track in tracks]
+    return {
+        "slugify x100": measure(lambda: [slugify(name) for name in names], iterations),
+        "get_track_save_location x100": measure(
+            lambda: [downloader.get_track_save_location(track, ".mp3") for track in tracks], iterations),
+        "get_track_save_location[playlist] x100": measure(
+            lambda: [downloader.get_track_save_location(track, ".mp3", playlist_name="Benchmark Playlist",
+                                                        track_position=index + 1)
+                     for index, track in enumerate(tracks)], iterations),
+    }
+
+
+def compare(results, baseline):
+    def change(current, previous):
+        if current is None or previous is None or previous == 0:
+            return ""
+        return f"{(current - previous) / previous * 100:+.1f}%"
+
+    rows = list()
+    for name, result in results.items():
+        previous = baseline.get(name, dict())
+        rows.append((name,
+                     f"{result['time_per_op_ms']:.3f}", change(result["time_per_op_ms"], previous.get("time_per_op_ms")),
+                     result["bytes_written_per_op"],
+                     change(result["bytes_written_per_op"], previous.get("bytes_written_per_op")),
+                     f"{result['peak_memory_kb']:.0f}", change(result["peak_memory_kb"], previous.get("peak_memory_kb"))))
+    headers = ["Benchmark", "Time (ms)", "vs. baseline", "Bytes written", "vs. baseline", "Peak memory (KB)",
+               "vs. baseline"]
+    return tabulate(rows, headers=headers)
+
+
+@click.command()
+@click.option("--iterations", "-n", type=click.IntRange(1), default=20, help="the number of runs of each benchmark")
+@click.option("--size", "-s", "sizes_kb", type=click.IntRange(1), multiple=True, default=FIXTURE_SIZES_KB,
+              help="the size of a generated audio fixture in KB (may be repeated)")
+@click.option("--baseline", type=click.Path(dir_okay=False), default=BASELINE_PATH,
+              help="the file holding the baseline results")
+@click.option("--save-baseline", is_flag=True, help="store the results of this run as the new baseline")
+def main(iterations, sizes_kb, baseline, save_baseline):
+    # log lines would be counted as bytes written by the benchmarked code
+    logging.getLogger("mp3downloader").disabled = True
+    with tempfile.TemporaryDirectory() as workdir:
+        results = bench_tagging(workdir, iterations, sizes_kb)
+    results.update(bench_cache(iterations))
+    results.update(bench_paths(iterations))
+
+    baseline_results = dict()
+    if os.path.exists(baseline):
+        with open(baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)
+    print(compare(results, baseline_results))
+
+    if save_baseline:
+        with open(baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline has been saved to {baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,9 @@ class DownloadTimeoutException(DownloaderException):
 class ServerError(DownloaderException):
     pass
 
+class DownloadCancelledException(DownloaderException):
+    pass
+
 class UIException(Exception):
     pass
 
@@ -21,4 +24,7 @@ class TaggerException(Exception):
     pass
 
 class InvalidInput(ValueError):
-    pass
\ No newline at end of file
+    pass
+
+class TranscoderException(Exception):
+    pass
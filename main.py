@@ -5,11 +5,12 @@ import logging
 import os
 import re
 import shutil
+import threading
 import time
 import traceback
 from pathlib import Path
 from time import sleep
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
 
 import click
 import deezer
@@ -18,29 +19,39 @@ from deezer import Track, Playlist, Album, Artist
 from deezer.exceptions import DeezerAPIException
 from selenium import webdriver
 from selenium.common.exceptions import ElementClickInterceptedException, NoSuchElementException, TimeoutException
+from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from tabulate import tabulate
 
 import ui_elements
+from backends import DownloadBackend, HedgedScheduler, LocalDirectoryBackend
 from custom_solver import CustomRecaptchaSolver
 from exceptions import UnsupportedFormatException, UnsupportedBitrateException, UIException, DownloaderException, \
-    InvalidInput, DownloadTimeoutException, ServerError
+    InvalidInput, DownloadTimeoutException, ServerError, DownloadCancelledException
+from prefetcher import MetadataPrefetcher
+from search import SearchCache
 from tagger import DeezerTagger
+from tracer import tracer, traced
+from transcoder import Transcoder, FORMAT_LABELS, get_best_format_label, get_format_label, parse_format_label
 
-# logging setup
 logger = logging.getLogger("mp3downloader")
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler = logging.FileHandler('mp3downloader.log', mode='w')
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-stdout_handler = logging.StreamHandler()
-stdout_handler.setLevel(logging.INFO)
-stdout_handler.setFormatter(formatter)
-stdout_handler.propagate = False
-logger.addHandler(stdout_handler)
+
+
+def setup_logging():
+    # called by the CLI rather than on import, so that importing this module (e.g. by benchmark.py) leaves the log alone
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler('mp3downloader.log', mode='w')
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    stdout_handler = logging.StreamHandler()
+    stdout_handler.setLevel(logging.INFO)
+    stdout_handler.setFormatter(formatter)
+    stdout_handler.propagate = False
+    logger.addHandler(stdout_handler)
+
 
 # settings
 WAIT_ENGINE_DEFAULT_RESET_INTERMAL = 15  # after every x minutes the wait engine will require a long break
@@ -49,6 +60,31 @@ LONG_WAIT_GAMMA_PARAMETERS = (6, 60)  # see: https://www.medcalc.org/manual/gamm
 _HOME_DIR = Path.home()
 DOWNLOAD_DIR = os.path.join(_HOME_DIR, "Downloads", "Music")
 BYPASS_WAIT = True  # determines whether the wait engine should wait between actions
+FREE_MP3_DOWNLOAD_URL = "https://free-mp3-download.net"
+HEDGE_DELAY = 90  # seconds before a slow download is also requested from another backend, until typical latency is known
+HEDGE_LATENCY_QUANTILE = 0.9  # downloads slower than this quantile of recent downloads are hedged
+PREFETCH_WINDOW = 5  # how many upcoming tracks have their metadata and artwork fetched in the background
+PREFETCH_MAX_ENTRIES = 50  # the maximal number of tracks whose prefetched metadata is held in memory
+SEARCH_CACHE_TTL = 600  # seconds for which the results of an interactive search are reused
+SEARCH_PAGE_SIZE = 15  # the number of search results shown at once
+BLOCK_RESOURCES = True  # determines whether the browser should skip loading resources the automation does not use
+SITE_HOSTS = ["free-mp3-download.net"]  # the resource types below are blocked only when served from these hosts
+BLOCKED_RESOURCE_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "webp", "svg", "ico", "woff", "woff2", "ttf", "otf", "eot",
+                               "mp4", "webm"]
+BLOCKED_DOMAINS = ["doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+                   "googletagmanager.com", "googletagservices.com", "fonts.googleapis.com", "facebook.net", "facebook.com",
+                   "twitter.com", "cloudflareinsights.com", "popads.net", "propellerads.com", "adsterra.com",
+                   "amazon-adsystem.com"]
+# never blocked, even when listed in BLOCKED_DOMAINS or SITE_HOSTS, since the CAPTCHA is served from them
+ALLOWED_DOMAINS = ["google.com", "gstatic.com", "recaptcha.net"]
+DOWNLOAD_START_TIMEOUT = 30  # seconds to wait for a download to start
+DOWNLOAD_STALL_TIMEOUT = 15  # a download is considered stalled if no bytes arrive for this many seconds
+DOWNLOAD_MIN_TIMEOUT = 60  # seconds, the lower bound of the size-based download timeout
+DOWNLOAD_MIN_THROUGHPUT = 32 * 1024  # bytes per second, assumed until the throughput of a download has been observed
+DOWNLOAD_TIMEOUT_SAFETY_FACTOR = 4  # the timeout tolerates downloads this many times slower than the estimated speed
+THROUGHPUT_SMOOTHING = 0.3  # the weight of the latest download in the running throughput estimate
+FLAC_ESTIMATED_BITRATE = 1000  # kbps, the typical bitrate of a 16 bit 44.1 kHz stereo FLAC track
+TRANSCODER_WORKERS = None  # the number of tracks encoded at once when extra formats are requested, None for all cores
 
 
 class WaitEngine:
@@ -71,6 +107,7 @@ class WaitEngine:
         self.nextReset += delta
         self.lastPause = None
 
+    @traced("WaitEngine.wait")
     def wait(self, minimum=0, message=""):
         if self.lastPause is not None:
             return
@@ -97,75 +134,177 @@ class WaitEngine:
             sleep(penalty)
 
 
-class Downloader:
+class ThroughputEstimator:
+    def __init__(self, smoothing=THROUGHPUT_SMOOTHING):
+        self.smoothing = smoothing
+        self.estimate = None  # bytes per second
+
+    def update(self, size, duration):
+        if size <= 0 or duration <= 0:
+            return
+        throughput = size / duration
+        if self.estimate is None:
+            self.estimate = throughput
+        else:
+            self.estimate = self.smoothing * throughput + (1 - self.smoothing) * self.estimate
+        logger.debug(f"Download throughput was {throughput / 1024:.0f} KB/s, "
+                     f"estimated throughput is {self.estimate / 1024:.0f} KB/s")
+
+    def get_timeout(self, expected_size):
+        """Returns the number of seconds a download of the given size (in bytes) may take after it starts"""
+        if expected_size is None:
+            return DOWNLOAD_MIN_TIMEOUT
+        throughput = DOWNLOAD_MIN_THROUGHPUT if self.estimate is None else max(self.estimate, DOWNLOAD_MIN_THROUGHPUT)
+        return max(DOWNLOAD_MIN_TIMEOUT, DOWNLOAD_TIMEOUT_SAFETY_FACTOR * expected_size / throughput)
+
+
+class FreeMp3DownloadBackend(DownloadBackend):
+    """Downloads tracks through the page flow of free-mp3-download.net, or of a mirror of it, in a Chrome window"""
     supported_formats = ["mp3", "flac"]
 
-    def __init__(self):
+    def __init__(self, base_url=FREE_MP3_DOWNLOAD_URL, download_dir=DOWNLOAD_DIR, home_page=ui_elements.HOME_PAGE,
+                 download_page=ui_elements.DOWNLOAD_PAGE):
+        super().__init__(urlparse(base_url).hostname, download_dir)
+        self.base_url = base_url.rstrip("/")
+        self.home_page = home_page
+        self.download_page = download_page
         self.wait_engine = WaitEngine()
         self.wait_engine.pause()
         self.bitrate = "320"
         self.format = "mp3"
+        self.cancelled = threading.Event()
 
-        logger.info("Opening a new browser window")
-        self.download_path = DOWNLOAD_DIR
-        self.browser = None
+        self.browser = None  # opened on the first download, so that a backend which is never used costs nothing
         self.captcha_solver = None
-        self.init_browser()
+        self.session_ready = False
+        self.throughput_estimator = ThroughputEstimator()
 
     def init_browser(self):
         options = webdriver.ChromeOptions()
         options.add_experimental_option("prefs", {
-            "download.default_directory": self.download_path
+            "download.default_directory": self.download_dir
         })
         options.add_experimental_option('excludeSwitches', ['enable-logging'])
         if self.browser is not None:
-            self.browser.close()
+            self.browser.quit()
+        logger.info(f"Opening a new browser window for {self.name}")
         self.browser = webdriver.Chrome(options=options)
         self.captcha_solver = CustomRecaptchaSolver(driver=self.browser)
+        self.session_ready = False
+        if BLOCK_RESOURCES:
+            self._block_resources()
 
-    def set_format(self, format, bitrate):
-        if format is None or format not in Downloader.supported_formats:
-            raise UnsupportedFormatException
-        if format == "mp3":
-            if bitrate not in ["128", "320"]:
-                raise UnsupportedBitrateException
-        elif format == "flac":
-            bitrate = None
+    def _block_resources(self):
+        blocked_url_patterns = get_blocked_url_patterns(SITE_HOSTS + [self.name])
+        try:
+            self.browser.execute_cdp_cmd("Network.enable", {})
+            self.browser.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_url_patterns})
+            logger.debug(f"Blocking {len(blocked_url_patterns)} URL patterns in the browser")
+        except Exception:
+            logger.warning("Could not set up resource blocking in the browser")
+            logger.debug(traceback.format_exc())
+
+    def download(self, track, format, bitrate, cancelled):
         self.format = format
         self.bitrate = bitrate
+        self.cancelled = cancelled
+        if self.browser is None:
+            self.init_browser()
+        self.wait_engine.resume()
+        existing_files = None
+        try:
+            self._open_download_page(track)
+            self._check_cancelled()
+            # files left over from earlier downloads must not be mistaken for this one
+            existing_files = set(glob.glob(os.path.join(self.download_dir, "*.*")))
+            self._process_download_page()
+            return self._wait_for_download_finish(expected_size=self._get_expected_size(track),
+                                                  existing_files=existing_files)
+        except DownloadTimeoutException:
+            logger.error(f"Download timeout: {track.artist.name} - {track.title}")
+            self.on_download_tineout()
+            if existing_files is not None:
+                self._remove_new_files(existing_files)
+            raise
+        except DownloadCancelledException:
+            # the browser is reopened by the next download from this backend, if there is one
+            logger.info(f"Closing browser, to stop downloading track {track.id} from {self.name}")
+            self.close()
+            if existing_files is not None:
+                self._remove_new_files(existing_files)
+            raise
+        except Exception:
+            # the next track starts over from the homepage, in case the failure left the session in a bad state
+            self.session_ready = False
+            raise
+        finally:
+            self.wait_engine.pause()
+
+    def on_download_tineout(self):
+        logger.info("Closing browser and reopening, to ensure no files are being downloaded at the moment")
+        self.init_browser()
 
+    def close(self):
+        if self.browser is not None:
+            self.browser.quit()
+            self.browser = None
+
+    def _remove_new_files(self, existing_files):
+        """Removes the partial or finished files of a cancelled download, which is every file not in existing_files"""
+        for path in glob.glob(os.path.join(self.download_dir, "*.*")):
+            if path in existing_files:
+                continue
+            logger.debug(f"Removing '{os.path.basename(path)}' of the cancelled download")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise DownloadCancelledException
+
+    @traced("FreeMp3DownloadBackend._open_download_page")
     def _open_download_page(self, track):
-        logger.debug("Going back to homepage")
-        self.browser.get("https://free-mp3-download.net/")
         try:
-            WebDriverWait(self.browser, 30).until(
-                EC.presence_of_element_located(ui_elements.HOME_PAGE["search_btn"])
-            )
+            if not self.session_ready:
+                logger.debug("Going back to homepage")
+                self.browser.get(f"{self.base_url}/")
+                WebDriverWait(self.browser, 30).until(
+                    EC.presence_of_element_located(self.home_page["search_btn"])
+                )
+                self.session_ready = True
             logger.info(f"Opening the download page of track {track.id} ({track.artist.name} - {track.title})")
             query_parameter = quote(f"{track.artist.name} - {track.title}")
             encoded_query = base64.b64encode(query_parameter.encode()).decode()
-            url = f"https://free-mp3-download.net/download.php?id={track.id}&q={encoded_query}"
+            url = f"{self.base_url}/download.php?id={track.id}&q={encoded_query}"
             logger.info(f"Navigating to {url}")
+            previous_page = self.browser.find_element(By.TAG_NAME, "html")
             self.browser.execute_script(
                 f'window.location.href = "{url}"')
             logger.debug("Waiting for page load")
+            # the previous page may be a download page too, so its download button must not be mistaken for the new one
+            WebDriverWait(self.browser, 30).until(EC.staleness_of(previous_page))
             WebDriverWait(self.browser, 30).until(
-                EC.presence_of_element_located(ui_elements.DOWNLOAD_PAGE["download_btn"])
+                EC.presence_of_element_located(self.download_page["download_btn"])
             )
         except Exception as e:
+            # the next track starts over from the homepage, in case the session is no longer valid
+            self.session_ready = False
             logger.error("Failed to load the download page")
             logger.debug(traceback.format_exc())
 
     def _get_format_selector(self):
         if self.format == "mp3":
-            return self.browser.find_element(*ui_elements.DOWNLOAD_PAGE[f"mp3_{self.bitrate}_radio_btn"])
+            return self.browser.find_element(*self.download_page[f"mp3_{self.bitrate}_radio_btn"])
         elif self.format == "flac":
-            return self.browser.find_element(*ui_elements.DOWNLOAD_PAGE["flac_radio_btn"])
+            return self.browser.find_element(*self.download_page["flac_radio_btn"])
         else:
             raise UIException("The requested format is unavailable")
 
+    @traced("FreeMp3DownloadBackend._handle_captcha")
     def _handle_captcha(self):
-        recaptcha_iframe = self.browser.find_elements(*ui_elements.DOWNLOAD_PAGE["captcha"])
+        recaptcha_iframe = self.browser.find_elements(*self.download_page["captcha"])
         if len(recaptcha_iframe) <= 0:
             return
         recaptcha_iframe = recaptcha_iframe[0]
@@ -179,18 +318,20 @@ class Downloader:
             logger.debug("CPATCHA challenge has been solved automatically")
         except:
             logger.debug("Could not solve recaptcha automatically. User has to solve it manually", exc_info=True)
-            click.echo("Please solve the CAPTCHA challenge before proceeding.")
-            click.confirm("Have you solved it?", default=True)
+            with self.prompting_user(self.cancelled):
+                click.echo(f"Please solve the CAPTCHA challenge in the {self.name} browser window before proceeding.")
+                click.confirm("Have you solved it?", default=True)
             logger.debug("The user reports that the CAPTCHA challenge has been solved")
         self.wait_engine.resume()
 
+    @traced("FreeMp3DownloadBackend._process_download_page")
     def _process_download_page(self):
         format_selector = self._get_format_selector()
         self.browser.execute_script("arguments[0].click();", format_selector)
         self._handle_captcha()
         # format_selector.click()
         download_btn = WebDriverWait(self.browser, 30).until(
-            EC.element_to_be_clickable(ui_elements.DOWNLOAD_PAGE["download_btn"])
+            EC.element_to_be_clickable(self.download_page["download_btn"])
         )
         self.wait_engine.wait()
 
@@ -205,13 +346,14 @@ class Downloader:
     def _is_error_toast_displayed(self):
         try:
             WebDriverWait(self.browser, 10).until(
-                EC.presence_of_element_located(ui_elements.DOWNLOAD_PAGE["error_toast"])
+                EC.presence_of_element_located(self.download_page["error_toast"])
             )
             return True
         except (NoSuchElementException, TimeoutException):
             return False
 
-    def _wait_for_download_finish(self, success_cb=lambda *args: None, wait_time=1):
+    @traced("FreeMp3DownloadBackend._wait_for_download_finish")
+    def _wait_for_download_finish(self, expected_size=None, existing_files=frozenset()):
         def _update_status(download_status):
             if _update_status.download_status == download_status:
                 return
@@ -226,14 +368,29 @@ class Downloader:
         _update_status.download_status = -1
 
         _update_status(0)
-        wait_until = datetime.datetime.now() + datetime.timedelta(minutes=wait_time)
-        while datetime.datetime.now() <= wait_until:
-            dir_content = glob.glob(os.path.join(self.download_path, "*.*"))
+        start_time = time.monotonic()
+        download_start_time = None
+        deadline = start_time + DOWNLOAD_START_TIMEOUT
+        last_size = 0
+        last_progress_time = start_time
+        tracked_file = None
+        while True:
+            self._check_cancelled()
+            now = time.monotonic()
+            if now > deadline:
+                logger.debug("Download did not finish in time")
+                break
+            if download_start_time is not None and now - last_progress_time > DOWNLOAD_STALL_TIMEOUT:
+                logger.debug(f"Download stalled, no bytes arrived in the last {DOWNLOAD_STALL_TIMEOUT} seconds")
+                break
+            dir_content = [path for path in glob.glob(os.path.join(self.download_dir, "*.*"))
+                           if path not in existing_files]
             if len(dir_content) == 0:
                 _update_status(1)
             else:
                 try:
                     latest_file = max(dir_content, key=os.path.getctime)
+                    size = os.path.getsize(latest_file)
                 except FileNotFoundError as e:
                     # This exception may occur if one of the files in dir_content changed its name, was moved or
                     # removed. After download finish Chrome usually changes the file name, and if we don't have luck it
@@ -241,20 +398,76 @@ class Downloader:
                     logger.debug("Directory structure changed")
                     continue
                 _, extension = os.path.splitext(latest_file)
-                if extension[1:] not in Downloader.supported_formats:
+                if latest_file != tracked_file:
+                    if tracked_file is not None and not os.path.exists(tracked_file):
+                        # Chrome renamed the file it was downloading to, e.g. because the download has finished
+                        tracked_file = latest_file
+                    else:
+                        # progress is followed per file, so that another file does not count towards this one
+                        tracked_file = latest_file
+                        download_start_time = last_progress_time = now
+                        last_size = 0
+                        timeout = self.throughput_estimator.get_timeout(expected_size)
+                        deadline = now + timeout
+                        logger.debug(f"Download timeout is {timeout:.0f} seconds")
+                if size != last_size:
+                    last_size = size
+                    last_progress_time = now
+                    if expected_size is not None and size > 0 and now > download_start_time:
+                        # a download which keeps progressing is not cut off, even if it is slower than estimated
+                        remaining_size = max(expected_size - size, 0)
+                        deadline = max(deadline, now + remaining_size * (now - download_start_time) / size
+                                       + DOWNLOAD_STALL_TIMEOUT)
+                if extension[1:] not in FreeMp3DownloadBackend.supported_formats:
                     _update_status(2)
                 else:
-                    return success_cb(latest_file)
+                    self.throughput_estimator.update(size, now - download_start_time)
+                    return latest_file
             time.sleep(1)
         raise DownloadTimeoutException
 
-    def get_track_save_location(self, track, extension, playlist_name=None, track_position=None, target_dir=None):
+    def _get_expected_size(self, track):
+        """Estimates the size of the track's file in bytes, based on its duration and the chosen format"""
+        duration = getattr(track, "duration", None)
+        if not duration:
+            return None
+        bitrate = FLAC_ESTIMATED_BITRATE if self.format == "flac" else int(self.bitrate)
+        return duration * bitrate * 1000 // 8
+
+
+
+class Downloader:
+    supported_formats = ["mp3", "flac"]
+
+    def __init__(self, backends=None):
+        self.bitrate = "320"
+        self.format = "mp3"
+        self.download_path = DOWNLOAD_DIR
+        if backends is None:
+            backends = [FreeMp3DownloadBackend(download_dir=self.download_path)]
+        self.scheduler = HedgedScheduler(backends, hedge_delay=HEDGE_DELAY, latency_quantile=HEDGE_LATENCY_QUANTILE)
+
+    def set_format(self, format, bitrate):
+        if format is None or format not in Downloader.supported_formats:
+            raise UnsupportedFormatException
+        if format == "mp3":
+            if bitrate not in ["128", "320"]:
+                raise UnsupportedBitrateException
+        elif format == "flac":
+            bitrate = None
+        self.format = format
+        self.bitrate = bitrate
+
+    def get_track_save_location(self, track, extension, playlist_name=None, track_position=None, target_dir=None,
+                                root_dir=None):
         artist = track.artist.name
         album = track.album.title
+        if root_dir is None:
+            root_dir = self.download_path
         if target_dir is None and playlist_name is not None and track_position is not None:
-            target_dir = os.path.join(self.download_path, slugify(playlist_name))
+            target_dir = os.path.join(root_dir, slugify(playlist_name))
         elif target_dir is None:
-            target_dir = os.path.join(self.download_path, slugify(artist), slugify(album))
+            target_dir = os.path.join(root_dir, slugify(artist), slugify(album))
         if track_position is None:
             position = f"{track.disk_number}-{track.track_position:02}"
         else:
@@ -264,11 +477,11 @@ class Downloader:
         new_filepath = os.path.join(target_dir, f"{new_filename}{extension}")
         return new_filepath
 
-    def download(self, track, playlist_name=None, track_position=None):
+    def download(self, track, playlist_name=None, track_position=None, root_dir=None):
         def on_download_success(filepath):
             _, extension = os.path.splitext(filepath)
             new_filepath = self.get_track_save_location(track, extension, playlist_name=playlist_name,
-                                                        track_position=track_position)
+                                                        track_position=track_position, root_dir=root_dir)
             logger.debug(f"Renaming '{os.path.basename(filepath)}' to '{os.path.basename(new_filepath)}'")
             target_dir = os.path.dirname(new_filepath)
             if not os.path.exists(target_dir):
@@ -280,43 +493,35 @@ class Downloader:
 
 
         filepath = self.get_track_save_location(track, "." + self.format, playlist_name=playlist_name,
-                                                track_position=track_position)
+                                                track_position=track_position, root_dir=root_dir)
         if os.path.exists(filepath):
             logger.info(f"Skipping track {track.id}, since it has already been downloaded to '{filepath}'")
             return filepath
-        self.wait_engine.resume()
-        self._open_download_page(track)
-        try:
-            self._process_download_page()
-            filepath = self._wait_for_download_finish(success_cb=on_download_success)
-            if filepath is not None:
-                return filepath
-        except DownloadTimeoutException as e:
-            logger.error(f"Download timeout: {track.artist.name} - {track.title}", exc_info=e)
-            self.on_download_tineout()
-        except (NoSuchElementException, Exception) as e:
-            logger.error(f"Could not download {track.artist.name} - {track.title}", exc_info=e)
-        finally:
-            self.wait_engine.pause()
-
-    def on_download_tineout(self):
-        logger.info("Closing browser and reopening, to ensure no files are being downloaded at the moment")
-        self.init_browser()
-
-    def download_tracks(self, deezer_entity):
+        with tracer.span("Downloader.download", track_id=track.id):
+            try:
+                filepath = self.scheduler.download(track, self.format, self.bitrate)
+                return on_download_success(filepath)
+            except Exception as e:
+                logger.error(f"Could not download {track.artist.name} - {track.title}", exc_info=e)
+
+    def close(self):
+        self.scheduler.close()
+
+    def download_tracks(self, deezer_entity, prefetcher=None, root_dir=None, on_download=None):
+        """
+        Downloads every track of the Deezer entity, and returns the downloaded files mapped to their tracks.
+        on_download, if given, is called with the path and the track of each file as soon as it has been downloaded.
+        """
         track_map = dict()
+        playlist_name = None
         logger.debug(f"User asked to download {deezer_entity.link}")
         if isinstance(deezer_entity, Playlist):
-            track_list = deezer_entity.tracks
-            for index, track in enumerate(track_list):
-                filepath = self.download(track, playlist_name=deezer_entity.title, track_position=index + 1)
-                if filepath is not None:
-                    track_map[filepath] = track
-            return track_map
+            track_list = list(deezer_entity.tracks)
+            playlist_name = deezer_entity.title
         elif isinstance(deezer_entity, Track):
             track_list = [deezer_entity]
         elif isinstance(deezer_entity, Album):
-            track_list = deezer_entity.tracks
+            track_list = list(deezer_entity.tracks)
         elif isinstance(deezer_entity, Artist):
             albums = deezer_entity.get_albums()
             track_list = list()
@@ -326,13 +531,39 @@ class Downloader:
         else:
             raise DownloaderException("Unsupported Deezer entity")
 
+        if prefetcher is not None:
+            prefetcher.enqueue(track_list)
         for index, track in enumerate(track_list):
-            filepath = self.download(track)
+            if prefetcher is not None:
+                prefetcher.advance(index)
+            if playlist_name is not None:
+                filepath = self.download(track, playlist_name=playlist_name, track_position=index + 1,
+                                         root_dir=root_dir)
+            else:
+                filepath = self.download(track, root_dir=root_dir)
             if filepath is not None:
                 track_map[filepath] = track
+                if on_download is not None:
+                    on_download(filepath, track)
+            elif prefetcher is not None:
+                prefetcher.discard(track)
         return track_map
 
 
+def get_blocked_url_patterns(site_hosts=SITE_HOSTS):
+    def is_allowed(domain):
+        return any(domain == allowed or domain.endswith(f".{allowed}") for allowed in ALLOWED_DOMAINS)
+
+    site_hosts = [host for host in dict.fromkeys(site_hosts) if not is_allowed(host)]
+    patterns = [f"*://{host}/*.{extension}*" for host in site_hosts for extension in BLOCKED_RESOURCE_EXTENSIONS]
+    patterns += [f"*://*.{host}/*.{extension}*" for host in site_hosts for extension in BLOCKED_RESOURCE_EXTENSIONS]
+    for domain in BLOCKED_DOMAINS:
+        if is_allowed(domain):
+            continue
+        patterns += [f"*://{domain}/*", f"*://*.{domain}/*"]
+    return patterns
+
+
 def process_deezer_url(url):
     client = deezer.Client()
     match = re.match("^(https:\/\/www\.deezer\.com\/([^\/]*\/)?)(playlist|album|track|artist)\/(\d*)", url)
@@ -341,30 +572,42 @@ def process_deezer_url(url):
     urlType = match.group(3)
     urlId = match.group(4)
     try:
-        if urlType == "album":
-            album_id = urlId
-            album = client.get_album(album_id)
-            return album
-        elif urlType == "track":
-            track_id = urlId
-            track = client.get_track(track_id)
-            return track
-        elif urlType == "playlist":
-            playlist_id = urlId
-            playlist = client.get_playlist(playlist_id)
-            return playlist
-        elif urlType == "artist":
-            artist_id = urlId
-            artist = client.get_artist(artist_id)
-            return artist
+        with tracer.span("deezer_api", category="deezer", entity=urlType, entity_id=urlId):
+            return _get_deezer_entity(client, urlType, urlId)
     except DeezerAPIException as e:
         logger.error("A Deezer API error occurred", exc_info=e)
         raise DownloaderException("Cannot access the track(s) in the provided Deezer URL")
 
 
-def tag_downloaded_files(downloaded_files: dict[str, Track]):
-    tagger = DeezerTagger()
+def _get_deezer_entity(client, urlType, urlId):
+    if urlType == "album":
+        album_id = urlId
+        album = client.get_album(album_id)
+        return album
+    elif urlType == "track":
+        track_id = urlId
+        track = client.get_track(track_id)
+        return track
+    elif urlType == "playlist":
+        playlist_id = urlId
+        playlist = client.get_playlist(playlist_id)
+        return playlist
+    elif urlType == "artist":
+        artist_id = urlId
+        artist = client.get_artist(artist_id)
+        return artist
+
+
+def tag_downloaded_files(downloaded_files: dict[str, Track], prefetcher=None):
+    tagger = DeezerTagger(prefetcher=prefetcher)
+    # the same track may appear several times, once for every format it was saved in
+    unique_tracks = list({track.id: track for track in downloaded_files.values()}.values())
+    track_positions = {track.id: index for index, track in enumerate(unique_tracks)}
+    if prefetcher is not None:
+        prefetcher.enqueue(unique_tracks)
     for filepath, track in downloaded_files.items():
+        if prefetcher is not None:
+            prefetcher.advance(track_positions[track.id])
         try:
             filename = os.path.basename(filepath)
             logger.info(f"Adding the metadata tags of track {track.id} to {filename}")
@@ -385,52 +628,133 @@ def slugify(string):
     return "".join(f)
 
 
-def process_deezer_entity(downloader, format, bitrate, deezer_entity):
-    downloader.set_format(format, bitrate)
-    downloaded_files = downloader.download_tracks(deezer_entity)
-    tag_downloaded_files(downloaded_files)
-
+def submit_transcode_jobs(transcoder, source, source_root, format_labels, target_root):
+    """
+    Starts encoding a downloaded file to each of the given formats, and returns the futures of the encoded files.
+    The encoded files keep the layout the downloaded file has under source_root, under a directory named after their
+    format in target_root.
+    """
+    jobs = list()
+    relative_path, _ = os.path.splitext(os.path.relpath(source, source_root))
+    for label in format_labels:
+        format, bitrate = parse_format_label(label)
+        target = os.path.join(target_root, label, f"{relative_path}.{format}")
+        jobs.append(transcoder.submit(source, target, format, bitrate))
+    return jobs
+
+
+def collect_transcoded_files(downloaded_files: dict[str, Track], jobs):
+    """Waits for the transcode jobs of the downloaded files, and returns the downloaded and the encoded files"""
+    all_files = dict()
+    for source, track in downloaded_files.items():
+        all_files[source] = track
+        for job in jobs.get(source, ()):
+            try:
+                target = job.result()
+                logger.info(f"Track {track.id} has been transcoded to {target}")
+                all_files[target] = track
+            except Exception:
+                logger.error(f"Could not transcode {source}")
+                logger.debug(traceback.format_exc())
+    return all_files
+
+
+def process_deezer_entity(downloader, format, bitrate, deezer_entity, extra_formats=()):
+    format_labels = {get_format_label(format, bitrate), *extra_formats}
+    source_label = get_best_format_label(format_labels)
+    format_labels.remove(source_label)
+    # with several formats, each one is saved under its own directory, so that e.g. mp3-128 and mp3-320 do not collide
+    source_root = os.path.join(downloader.download_path, source_label) if format_labels else None
+    downloader.set_format(*parse_format_label(source_label))
+    transcoder = Transcoder(max_workers=TRANSCODER_WORKERS) if format_labels else None
+    prefetcher = MetadataPrefetcher(window=PREFETCH_WINDOW, max_entries=PREFETCH_MAX_ENTRIES)
+    transcode_jobs = dict()  # downloaded file -> futures of its encoded files
+
+    def on_download(filepath, track):
+        # each track is encoded while the next ones are being downloaded
+        transcode_jobs[filepath] = submit_transcode_jobs(transcoder, filepath, source_root, sorted(format_labels),
+                                                         downloader.download_path)
 
-def process_user_search(query):
+    try:
+        downloaded_files = downloader.download_tracks(deezer_entity, prefetcher=prefetcher, root_dir=source_root,
+                                                      on_download=on_download if transcoder is not None else None)
+        if transcoder is not None:
+            downloaded_files = collect_transcoded_files(downloaded_files, transcode_jobs)
+        tag_downloaded_files(downloaded_files, prefetcher=prefetcher)
+    finally:
+        prefetcher.close()
+        if transcoder is not None:
+            transcoder.close()
+
+
+def process_user_search(query, search_cache):
     print("What are we searching for?")
     print("(1) artist")
     print("(2) album")
     print("(3) track")
     type = click.prompt("", type=click.Choice(["1", "2", "3", "artist", "album", "track"]))
-    client = deezer.Client()
-    max_results_shown = 15
     if type == "1" or type == "artist":
         logger.debug("User searched by artist")
-        results = client.search_artists(query)
+        kind = "artist"
         headers = ["Choice Number", "Artist"]
-        data = [(index + 1, artist.name) for index, artist in enumerate(results[:max_results_shown])]
     elif type == "2" or type == "album":
         logger.debug("User searched by album")
-        results = client.search_albums(query)
+        kind = "album"
         headers = ["Choice Number", "Artist", "Album", "Year"]
-        data = [(index + 1, album.artist.name, album.title, album.release_date.strftime("%Y")) for index, album in
-                enumerate(results[:max_results_shown])]
     elif type == "3" or type == "track":
         logger.debug("User searched by track")
-        results = client.search(query)
+        kind = "track"
         headers = ["Choice Number", "Artist", "Title", "Track#", "Album", "Year"]
-        data = [(index + 1, track.artist.name, track.title, track.track_position, track.album.title,
-                 track.album.release_date.strftime("%Y")) for index, track in enumerate(results[:max_results_shown])]
     else:
         raise InvalidInput
 
-    results_tbl_visual = tabulate(data, headers=headers)
-    print(results_tbl_visual)
-    logger.debug(f"User is presented the following results:\n{results_tbl_visual}")
-    choice = click.prompt("Please choose the desired result by typing in its choice number", type=click.IntRange(0, len(data)))
-    logger.debug(f"User chose result number {choice}")
-    choice -= 1
-    if choice < 0:
-        raise InvalidInput("User didn't find what he wanted")
-    return results[choice]
-
-
-def interact_with_user(downloader, format=None, bitrate=None):
+    page = 0
+    while True:
+        rows, has_more = search_cache.get_page(kind, query, page)
+        first_choice = page * search_cache.page_size + 1
+        data = [_get_search_result_row(kind, first_choice + index, row) for index, row in enumerate(rows)]
+        results_tbl_visual = tabulate(data, headers=headers)
+        print(results_tbl_visual)
+        logger.debug(f"User is presented the following results:\n{results_tbl_visual}")
+        commands = dict()  # only the commands which apply to this page are offered
+        if has_more:
+            commands["n"] = "next page"
+        if page > 0:
+            commands["p"] = "previous page"
+        commands["r"] = "refresh"
+        hint = ", ".join(f"{command}: {description}" for command, description in commands.items())
+        choice = click.prompt(f"Please choose the desired result by typing in its choice number ({hint})", type=str)
+        choice = choice.strip().lower()
+        if choice in commands:
+            logger.debug(f"User typed '{choice}'")
+            page += {"n": 1, "p": -1, "r": 0}[choice]
+            continue
+        try:
+            choice = int(choice)
+        except ValueError:
+            print(f"'{choice}' is not a valid choice")
+            continue
+        logger.debug(f"User chose result number {choice}")
+        if choice == 0:
+            raise InvalidInput("User didn't find what he wanted")
+        if not first_choice <= choice < first_choice + len(rows):
+            print(f"{choice} is not one of the shown choice numbers")
+            continue
+        return search_cache.resolve(rows[choice - first_choice])
+
+
+def _get_search_result_row(kind, choice, row):
+    def show(value):
+        return "..." if value is None else value
+
+    if kind == "artist":
+        return choice, row.artist
+    elif kind == "album":
+        return choice, row.artist, row.title, show(row.year)
+    return choice, row.artist, row.title, show(row.track_position), row.album, show(row.year)
+
+
+def interact_with_user(downloader, search_cache, format=None, bitrate=None, extra_formats=()):
     format = click.prompt("Choose a format", type=click.Choice(["mp3", "flac"]), default=format)
     if format == "mp3":
         bitrate = click.prompt("Choose bitrate", type=click.Choice(["128", "320"]), default=bitrate)
@@ -444,42 +768,87 @@ def interact_with_user(downloader, format=None, bitrate=None):
     if is_url:
         deezer_entity = process_deezer_url(query)
     else:
-        deezer_entity = process_user_search(query)
-    process_deezer_entity(downloader, format, bitrate, deezer_entity)
+        deezer_entity = process_user_search(query, search_cache)
+    process_deezer_entity(downloader, format, bitrate, deezer_entity, extra_formats)
     return format, bitrate
 
+
+def validate_mirrors(ctx, param, mirrors):
+    for mirror in mirrors:
+        parsed_url = urlparse(mirror)
+        if parsed_url.scheme not in ("http", "https") or not parsed_url.hostname:
+            raise click.BadParameter(f"'{mirror}' is not an http(s) URL, e.g. https://free-mp3-download.net")
+    return mirrors
+
+
 @click.command()
 @click.option("--url", "-u", type=str, default=None, help="URL to a Deezer playlist, album, artist or track page")
 @click.option("--format", "-f", type=click.Choice(["mp3", "flac"], case_sensitive=False), help="the audio format to download")
 @click.option("--bitrate", "-b", type=click.Choice(["320", "128"]), help="the audio bitrate to download, if mp3 is chosen")
-def main(url, format, bitrate):
+@click.option("--extra-format", "-e", "extra_formats", type=click.Choice(FORMAT_LABELS), multiple=True,
+              help="also save the tracks in this format (may be repeated). Only the best requested format is downloaded,"
+                   " and the others are encoded from it locally using ffmpeg")
+@click.option("--mirror", "-m", "mirrors", type=str, multiple=True, callback=validate_mirrors,
+              help="URL of a mirror of free-mp3-download.net, to download slow or failed tracks from (may be repeated)")
+@click.option("--local-source", type=click.Path(exists=True, file_okay=False), default=None,
+              help="a directory of audio files named after their Deezer track id, tried before the download sites")
+@click.option("--trace", "-t", "trace_path", type=click.Path(dir_okay=False, writable=True), default=None,
+              help="save a timeline of the run to this file, in the Chrome trace format (open it in Perfetto)")
+@click.option("--trace-sample-rate", type=click.FloatRange(0, 1), default=1.0,
+              help="the fraction of tracks to trace, if --trace is given")
+def main(url, format, bitrate, extra_formats, mirrors, local_source, trace_path, trace_sample_rate):
+    setup_logging()
     interactive_mode = url is None or format is None or (format == "mp3" and bitrate is None)
-    downloader = Downloader()
-    if interactive_mode:
-        start_interactive_mode(downloader)
-    else:
-        start_cli_mode(downloader, url, format, bitrate)
-
-def start_interactive_mode(downloader):
+    if trace_path is not None:
+        tracer.configure(enabled=True, sample_rate=trace_sample_rate)
+    downloader = None
+    try:
+        downloader = Downloader(create_backends(mirrors, local_source))
+        if interactive_mode:
+            start_interactive_mode(downloader, extra_formats)
+        else:
+            start_cli_mode(downloader, url, format, bitrate, extra_formats)
+    finally:
+        if downloader is not None:
+            downloader.close()
+        if trace_path is not None:
+            tracer.export(trace_path)
+
+
+def create_backends(mirrors=(), local_source=None):
+    # every backend gets its own download directory, so that their downloads are not mistaken for each other
+    backends = list()
+    if local_source is not None:
+        backends.append(LocalDirectoryBackend(local_source, os.path.join(DOWNLOAD_DIR, ".local")))
+    backends.append(FreeMp3DownloadBackend(download_dir=DOWNLOAD_DIR))
+    for mirror in mirrors:
+        backends.append(FreeMp3DownloadBackend(mirror, os.path.join(DOWNLOAD_DIR, ".mirrors", urlparse(mirror).hostname)))
+    return backends
+
+def start_interactive_mode(downloader, extra_formats=()):
     logger.debug("MP3 Downloader started in interactive mode")
     format = None
     bitrate = None
-    while 1:
-        try:
-            format, bitrate = interact_with_user(downloader, format, bitrate)
-        except:
-            logger.error("An error occurred during interaction. Read log for hints")
-            logger.debug(traceback.format_exc())
-        if not click.confirm("Would you like to download more stuff?"):
-            break
-
-def start_cli_mode(downloader, deezer_url, format, bitrate):
+    search_cache = SearchCache(ttl=SEARCH_CACHE_TTL, page_size=SEARCH_PAGE_SIZE)
+    try:
+        while 1:
+            try:
+                format, bitrate = interact_with_user(downloader, search_cache, format, bitrate, extra_formats)
+            except:
+                logger.error("An error occurred during interaction. Read log for hints")
+                logger.debug(traceback.format_exc())
+            if not click.confirm("Would you like to download more stuff?"):
+                break
+    finally:
+        search_cache.close()
+
+def start_cli_mode(downloader, deezer_url, format, bitrate, extra_formats=()):
     logger.debug("MP3 Downloader started in CLI mode")
     logger.debug(f"User chose format={format}, bitrate={bitrate}, url={deezer_url}")
     if format != "mp3":
         bitrate = None
     deezer_entity = process_deezer_url(deezer_url)
-    process_deezer_entity(downloader, format, bitrate, deezer_entity)
+    process_deezer_entity(downloader, format, bitrate, deezer_entity, extra_formats)
 
 
 if __name__ == "__main__":
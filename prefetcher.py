@@ -0,0 +1,131 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
+
+import requests
+from deezer import Track
+
+from tagger import DeezerTagger, TagsStruct
+from tracer import tracer
+
+logger = logging.getLogger("mp3downloader")
+
+
+class MetadataPrefetcher:
+    """
+    Walks ahead of the track queue and fetches the Deezer metadata and album artwork of upcoming tracks in the
+    background, so the tagger finds everything it needs already in memory.
+    At most `max_entries` tracks are held at once. A track's entry is freed once the tagger consumes it, or when it is
+    discarded because the track will not be tagged (e.g. its download failed).
+    """
+
+    def __init__(self, window=5, max_entries=50, max_workers=2, pop_timeout=10, request_timeout=20):
+        self.window = window
+        self.max_entries = max_entries
+        self.pop_timeout = pop_timeout  # seconds the tagger waits for a prefetch in progress
+        self.request_timeout = request_timeout  # seconds for an artwork request
+        self.queue = list()
+        self.entries = dict()  # track id -> future of TagsStruct
+        self.artwork = dict()  # artwork url -> image bytes
+        self.artwork_refs = dict()  # artwork url -> number of prefetched tracks using it
+        self.artwork_locks = dict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetcher")
+
+    def enqueue(self, tracks):
+        """Replaces the queue of upcoming tracks, and drops the prefetched tracks that are no longer in it"""
+        self.queue = list(tracks)
+        queued_ids = {track.id for track in self.queue}
+        with self.lock:
+            stale_ids = [track_id for track_id in self.entries if track_id not in queued_ids]
+        for track_id in stale_ids:
+            self._drop(track_id)
+
+    def advance(self, position):
+        """Starts prefetching the tracks in the window following `position` (inclusive) in the queue"""
+        for track in self.queue[position:position + self.window]:
+            with self.lock:
+                if track.id in self.entries:
+                    continue
+                if len(self.entries) >= self.max_entries:
+                    return
+                logger.debug(f"Prefetching the metadata of track {track.id}")
+                self.entries[track.id] = self.executor.submit(self._fetch, track)
+
+    def pop(self, track: Track):
+        """
+        Returns the prefetched tags of the track and releases them, or None if the track was not prefetched, or its
+        prefetch failed or did not finish within `pop_timeout` seconds. A prefetch which is still in progress is awaited
+        up to that long, since it is already ahead of a fresh fetch.
+        """
+        with self.lock:
+            future = self.entries.pop(track.id, None)
+        if future is None:
+            return None
+        try:
+            tags = future.result(timeout=self.pop_timeout)
+        except CancelledError:
+            return None
+        except TimeoutError:
+            logger.debug(f"Prefetching the metadata of track {track.id} is taking too long, fetching it directly")
+            if not future.cancel():
+                future.add_done_callback(self._release_future_artwork)
+            return None
+        except Exception:
+            logger.debug(f"Prefetching the metadata of track {track.id} failed", exc_info=True)
+            return None
+        self._release_artwork(tags.album_artwork)
+        return tags
+
+    def discard(self, track: Track):
+        """Cancels the prefetch of a track which is not going to be tagged"""
+        self._drop(track.id)
+
+    def close(self):
+        with self.lock:
+            track_ids = list(self.entries)
+        for track_id in track_ids:
+            self._drop(track_id)
+        self.executor.shutdown(wait=False)
+
+    def _drop(self, track_id):
+        with self.lock:
+            future = self.entries.pop(track_id, None)
+        if future is None or future.cancel():
+            return
+        future.add_done_callback(self._release_future_artwork)
+
+    def _release_future_artwork(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._release_artwork(future.result().album_artwork)
+
+    def _fetch(self, track: Track) -> TagsStruct:
+        with tracer.span("MetadataPrefetcher.fetch", track_id=track.id):
+            tags = DeezerTagger.build_tags(track)
+            with tracer.span("artwork_download"):
+                tags.album_artwork_data = self._get_artwork(tags.album_artwork)
+            return tags
+
+    def _get_artwork(self, url):
+        with self.lock:
+            url_lock = self.artwork_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            with self.lock:
+                data = self.artwork.get(url)
+            if data is None:
+                response = requests.get(url, timeout=self.request_timeout)
+                response.raise_for_status()
+                data = response.content
+            with self.lock:
+                self.artwork[url] = data
+                self.artwork_refs[url] = self.artwork_refs.get(url, 0) + 1
+        return data
+
+    def _release_artwork(self, url):
+        with self.lock:
+            self.artwork_refs[url] = self.artwork_refs.get(url, 1) - 1
+            if self.artwork_refs[url] <= 0:
+                del self.artwork_refs[url]
+                self.artwork.pop(url, None)
+                self.artwork_locks.pop(url, None)
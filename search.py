@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import deezer
+
+from exceptions import InvalidInput
+from tracer import tracer
+
+logger = logging.getLogger("mp3downloader")
+
+SEARCH_KINDS = ["artist", "album", "track"]
+
+
+def _get_loaded_field(resource, *path):
+    """
+    Returns a field of a Deezer resource (e.g. _get_loaded_field(track, "album", "title")) if it is already loaded,
+    or None otherwise. Unlike regular attribute access, a missing field is not fetched from the API.
+    """
+    value = resource
+    for field in path:
+        value = vars(value).get(field) if value is not None else None
+    return value
+
+
+class SearchResult:
+    """A compact row of search results. Fields which are not part of the base search response start as None."""
+    __slots__ = ("kind", "id", "artist", "title", "album", "track_position", "year")
+
+    def __init__(self, kind, resource):
+        self.kind = kind
+        self.id = resource.id
+        self.artist = _get_loaded_field(resource, "name") if kind == "artist" else \
+            _get_loaded_field(resource, "artist", "name")
+        self.title = _get_loaded_field(resource, "title")
+        self.album = _get_loaded_field(resource, "album", "title")
+        self.track_position = _get_loaded_field(resource, "track_position")
+        release_date = _get_loaded_field(resource, "release_date") if kind == "album" else \
+            _get_loaded_field(resource, "album", "release_date")
+        self.year = release_date.strftime("%Y") if release_date is not None else None
+
+    def is_hydrated(self):
+        if self.kind == "album":
+            return self.year is not None
+        elif self.kind == "track":
+            return self.year is not None and self.track_position is not None
+        return True
+
+    def hydrate(self, entity):
+        if self.kind == "album":
+            self.year = entity.release_date.strftime("%Y")
+        elif self.kind == "track":
+            self.track_position = entity.track_position
+            self.year = entity.album.release_date.strftime("%Y")
+
+
+class _CachedSearch:
+    def __init__(self, results):
+        self.results = results  # the lazy paginated list returned by the Deezer client
+        self.rows = list()
+        self.complete = False
+        self.created_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class SearchCache:
+    """
+    Caches the results of interactive searches for `ttl` seconds, and serves them a page at a time.
+    A page is returned as soon as its base search response arrives. The missing fields of its rows and the base
+    response of the following page are then fetched in the background, so that refreshing the page or moving to the
+    next one does not wait for the API. Only rows with missing fields are fetched in full, since Deezer allows about
+    50 requests per 5 seconds; the full entity of any other row is fetched when it is chosen.
+    """
+
+    def __init__(self, client=None, ttl=600, page_size=15, max_searches=32, max_entities=256, max_workers=4):
+        self.client = client if client is not None else deezer.Client()
+        self.ttl = ttl
+        self.page_size = page_size
+        self.max_searches = max_searches
+        self.max_entities = max_entities
+        self.searches = OrderedDict()  # (kind, query) -> _CachedSearch
+        self.entities = OrderedDict()  # (kind, id) -> future of the full Deezer entity
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+
+    def get_page(self, kind, query, page):
+        """Returns the rows of the given page (starting at 0), and whether there are more pages after it"""
+        search = self._get_search(kind, query)
+        rows, has_more = self._load_page(search, kind, page)
+        for row in rows:
+            if not row.is_hydrated():
+                self._get_entity_future(row)
+        if has_more:
+            self.executor.submit(self._prefetch_page, search, kind, page + 1)
+        return rows, has_more
+
+    def resolve(self, row: SearchResult):
+        """
+        Returns the full Deezer entity of the row, waiting for its background fetch if it is still in progress.
+        If the background fetch failed (e.g. on Deezer's quota limit), the entity is fetched again right away.
+        """
+        future = self._get_entity_future(row)
+        try:
+            return future.result()
+        except Exception:
+            logger.debug(f"Could not fetch {row.kind} {row.id} in the background, fetching it again", exc_info=True)
+            with self.lock:
+                self.entities.pop((row.kind, row.id), None)
+        return self._fetch_entity(row.kind, row.id)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _get_search(self, kind, query):
+        if kind not in SEARCH_KINDS:
+            raise InvalidInput(f"Cannot search for {kind}")
+        key = (kind, query.strip().lower())
+        with self.lock:
+            search = self.searches.get(key)
+            if search is not None and time.monotonic() - search.created_at <= self.ttl:
+                logger.debug(f"Search results for {kind} '{query}' are cached")
+                self.searches.move_to_end(key)
+                return search
+            if kind == "artist":
+                results = self.client.search_artists(query)
+            elif kind == "album":
+                results = self.client.search_albums(query)
+            else:
+                results = self.client.search(query)
+            search = self.searches[key] = _CachedSearch(results)
+            while len(self.searches) > self.max_searches:
+                self.searches.popitem(last=False)
+            return search
+
+    def _load_page(self, search, kind, page):
+        start = page * self.page_size
+        end = start + self.page_size
+        with search.lock:
+            if not search.complete and len(search.rows) <= end:
+                # one result more than the page, to tell whether there is a next page
+                with tracer.span("deezer_api", category="deezer", search_kind=kind, page=page):
+                    resources = search.results[len(search.rows):end + 1]
+                search.rows += [SearchResult(kind, resource) for resource in resources]
+                search.complete = len(search.rows) <= end
+            return search.rows[start:end], len(search.rows) > end
+
+    def _prefetch_page(self, search, kind, page):
+        # the rows of the next page are fetched in full only once that page is shown
+        try:
+            self._load_page(search, kind, page)
+        except Exception:
+            logger.debug("Could not prefetch the next page of search results", exc_info=True)
+
+    def _get_entity_future(self, row):
+        key = (row.kind, row.id)
+        with self.lock:
+            future = self.entities.get(key)
+            if future is None:
+                future = self.entities[key] = self.executor.submit(self._fetch_entity, row.kind, row.id)
+                while len(self.entities) > self.max_entities:
+                    self.entities.popitem(last=False)
+            else:
+                self.entities.move_to_end(key)
+        if not row.is_hydrated():
+            future.add_done_callback(lambda done_future: self._hydrate(row, done_future))
+        return future
+
+    def _fetch_entity(self, kind, entity_id):
+        with tracer.span("deezer_api", category="deezer", entity=kind, entity_id=entity_id):
+            if kind == "artist":
+                return self.client.get_artist(entity_id)
+            elif kind == "album":
+                return self.client.get_album(entity_id)
+            return self.client.get_track(entity_id)
+
+    @staticmethod
+    def _hydrate(row, future):
+        if row.is_hydrated() or future.cancelled() or future.exception() is not None:
+            return
+        try:
+            row.hydrate(future.result())
+        except Exception:
+            logger.debug(f"Could not fill in the fields of {row.kind} {row.id}", exc_info=True)
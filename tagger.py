@@ -10,6 +10,7 @@ import requests
 import logging
 
 from exceptions import TaggerException
+from tracer import tracer, traced
 
 logger = logging.getLogger("mp3downloader")
 
@@ -25,6 +26,7 @@ class TagsStruct:
         self.total_discs = None
         self.release_date = None
         self.album_artwork = None
+        self.album_artwork_data = None
         self.genres = None
         self.isrc = None
         self.label = None
@@ -37,11 +39,13 @@ class Tagger(ABC):
 
 
 class DeezerTagger(Tagger):
-    def __init__(self):
+    def __init__(self, prefetcher=None):
         self.filepath = None
         self.track = None
         self.file = None
         self.image_downloader = ImageDownloader()
+        self.prefetcher = prefetcher
+        self.tags_cache = Cache(size=5)  # a track may be tagged several times, once for every format it was saved in
         self.tag_engine = "music_tag"
 
     def _set_state(self, filepath: str, track: Track):
@@ -50,33 +54,34 @@ class DeezerTagger(Tagger):
         self.clear_tags()
 
     def tag(self, filepath: str, track: Track):
-        try:
-            self._set_state(filepath, track)
-            tags = self.get_tags_from_track()
-
-            self._open_file("music_tag")
-            self._add_conventional_tag("title", tags.title)
-            self._add_conventional_tag("artist", tags.artists)
-            self._add_conventional_tag("albumartist", tags.album_artist)
-            self._add_conventional_tag("album", tags.album)
-            self._add_conventional_tag("tracknumber", tags.track_position)
-            self._add_conventional_tag("totaltracks", tags.total_tracks)
-            self._add_conventional_tag("discnumber", tags.disc_number)
-            self._add_conventional_tag("totaldiscs", tags.total_discs)
-            self._add_conventional_tag("year", tags.release_date.strftime("%Y"))
-            self._set_artwork(tags.album_artwork)
-            self._add_conventional_tag("genre", tags.genres)
-            self._add_conventional_tag("isrc", tags.isrc)
-            self._commit()
-
-            self._open_file("mutagen")
-            self._add_custom_tag("date", tags.release_date.strftime("%Y-%m-%d"))
-            self._add_custom_tag("organization", tags.label)
-            self._commit()
-        except Exception as e:
-            self._rollback()
-            logger.error(traceback.format_exc())
-            raise TaggerException
+        with tracer.span("DeezerTagger.tag", track_id=track.id):
+            try:
+                self._set_state(filepath, track)
+                tags = self.get_tags_from_track()
+
+                self._open_file("music_tag")
+                self._add_conventional_tag("title", tags.title)
+                self._add_conventional_tag("artist", tags.artists)
+                self._add_conventional_tag("albumartist", tags.album_artist)
+                self._add_conventional_tag("album", tags.album)
+                self._add_conventional_tag("tracknumber", tags.track_position)
+                self._add_conventional_tag("totaltracks", tags.total_tracks)
+                self._add_conventional_tag("discnumber", tags.disc_number)
+                self._add_conventional_tag("totaldiscs", tags.total_discs)
+                self._add_conventional_tag("year", tags.release_date.strftime("%Y"))
+                self._set_artwork(tags.album_artwork, tags.album_artwork_data)
+                self._add_conventional_tag("genre", tags.genres)
+                self._add_conventional_tag("isrc", tags.isrc)
+                self._commit()
+
+                self._open_file("mutagen")
+                self._add_custom_tag("date", tags.release_date.strftime("%Y-%m-%d"))
+                self._add_custom_tag("organization", tags.label)
+                self._commit()
+            except Exception as e:
+                self._rollback()
+                logger.error(traceback.format_exc())
+                raise TaggerException
 
     def _commit(self):
         self.file.save()
@@ -116,6 +121,7 @@ class DeezerTagger(Tagger):
                 values = [value]
             self.file[tag] = values
 
+    @traced("DeezerTagger.clear_tags")
     def clear_tags(self):
         orig_tag_engine = self.tag_engine
         self._open_file("mutagen")
@@ -127,25 +133,41 @@ class DeezerTagger(Tagger):
         self.tag_engine = orig_tag_engine
 
     def get_tags_from_track(self) -> TagsStruct:
+        tags = self.tags_cache.search(self.track.id)
+        if tags is not None:
+            return tags
+        if self.prefetcher is not None:
+            tags = self.prefetcher.pop(self.track)
+            if tags is not None:
+                logger.debug(f"Using the prefetched metadata of track {self.track.id}")
+        if tags is None:
+            tags = DeezerTagger.build_tags(self.track)
+        self.tags_cache.put(self.track.id, tags)
+        return tags
+
+    @staticmethod
+    @traced("deezer_metadata", category="deezer")
+    def build_tags(track: Track) -> TagsStruct:
         tags = TagsStruct()
-        tags.title = self.track.title
-        tags.artists = [artist.name for artist in self.track.contributors]
-        tags.album_artist = self.track.artist.name
-        tags.album = self.track.album.title
-        tags.track_position = self.track.track_position
-        tags.total_tracks = self.track.album.nb_tracks
-        tags.disc_number = self.track.disk_number
-        tags.total_discs = max(track.disk_number for track in self.track.album.tracks)
-        tags.release_date = self.track.album.release_date
-        tags.album_artwork = self.track.album.cover_xl
-        tags.genres = [genre.name for genre in self.track.album.genres]
-        tags.isrc = self.track.isrc
-        tags.label = self.track.album.label
+        tags.title = track.title
+        tags.artists = [artist.name for artist in track.contributors]
+        tags.album_artist = track.artist.name
+        tags.album = track.album.title
+        tags.track_position = track.track_position
+        tags.total_tracks = track.album.nb_tracks
+        tags.disc_number = track.disk_number
+        tags.total_discs = max(album_track.disk_number for album_track in track.album.tracks)
+        tags.release_date = track.album.release_date
+        tags.album_artwork = track.album.cover_xl
+        tags.genres = [genre.name for genre in track.album.genres]
+        tags.isrc = track.isrc
+        tags.label = track.album.label
         return tags
 
-    def _set_artwork(self, url):
-        r = self.image_downloader.download(url)
-        with io.BytesIO(r.content) as buf:
+    def _set_artwork(self, url, data=None):
+        if data is None:
+            data = self.image_downloader.download(url).content
+        with io.BytesIO(data) as buf:
             self.file['artwork'] = buf.read()
 
 
@@ -186,6 +208,7 @@ class ImageDownloader:
     def __init__(self):
         self.image_cache = Cache(size=5)
 
+    @traced("ImageDownloader.download")
     def download(self, url):
         result = self.image_cache.search(url)
         if result is None:
@@ -0,0 +1,105 @@
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("mp3downloader")
+
+
+class Tracer:
+    """
+    Records timed spans of a run, and exports them in the Chrome Trace Event format, which can be opened in Perfetto
+    (https://ui.perfetto.dev) or chrome://tracing.
+    A span opened while no other span is open on the same thread starts a new trace, which is kept with probability
+    `sample_rate`. The decision of a trace with a `track_id` argument is derived from the track id, so that all the
+    traces of a track, on every thread, are either kept or dropped together. Nested spans follow the sampling decision
+    of their trace, and inherit the arguments of their parent span (e.g. the track id).
+    """
+
+    def __init__(self, enabled=False, sample_rate=1.0, max_events=100000):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.events = list()
+        self.thread_names = dict()
+        self.pid = os.getpid()
+        self._local = threading.local()
+
+    def configure(self, enabled=True, sample_rate=1.0):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def span(self, name, category="mp3downloader", **args):
+        if not self.enabled:
+            yield
+            return
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list()
+        if stack:
+            sampled, parent_args = stack[-1]
+        else:
+            sampled, parent_args = self._is_sampled(args.get("track_id")), dict()
+        span_args = {**parent_args, **args}
+        stack.append((sampled, span_args))
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            stack.pop()
+            if sampled:
+                self._record(name, category, start, end, span_args)
+
+    def _is_sampled(self, track_id=None):
+        if self.sample_rate >= 1:
+            return True
+        if track_id is None:
+            return random.random() < self.sample_rate
+        return random.Random(track_id).random() < self.sample_rate
+
+    def _record(self, name, category, start, end, args):
+        if len(self.events) >= self.max_events:
+            return
+        thread = threading.current_thread()
+        self.thread_names.setdefault(thread.ident, thread.name)
+        # list.append is atomic, so spans may be recorded from several threads without a lock
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": (end - start) / 1000,
+            "pid": self.pid,
+            "tid": thread.ident,
+            "args": {"worker": thread.name, **args},
+        })
+
+    def export(self, path):
+        metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": "mp3downloader"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                     for tid, name in self.thread_names.items()]
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}, trace_file)
+        logger.info(f"Trace of {len(self.events)} spans has been saved to {path}")
+
+
+tracer = Tracer()
+
+
+def traced(name, category="mp3downloader"):
+    """Decorates a function so that each of its calls is recorded as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,76 @@
+import logging
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from exceptions import TranscoderException
+from tracer import tracer
+
+logger = logging.getLogger("mp3downloader")
+
+FORMAT_LABELS = ["mp3-128", "mp3-320", "flac"]  # ordered from the lowest quality to the highest
+
+
+def parse_format_label(label):
+    """Splits a format label such as 'mp3-320' to a (format, bitrate) pair"""
+    if label not in FORMAT_LABELS:
+        raise TranscoderException(f"Unsupported format {label}")
+    format, _, bitrate = label.partition("-")
+    return format, bitrate or None
+
+
+def get_format_label(format, bitrate):
+    return format if format == "flac" else f"{format}-{bitrate}"
+
+
+def get_best_format_label(labels):
+    return max(labels, key=FORMAT_LABELS.index)
+
+
+def transcode(source, target, format, bitrate=None):
+    """Encodes the audio of the source file to the target file, without the source's tags and artwork"""
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source, "-map", "0:a", "-map_metadata", "-1",
+               "-threads", "1"]
+    if format == "mp3":
+        command += ["-codec:a", "libmp3lame", "-b:a", f"{bitrate}k", "-f", "mp3"]
+    elif format == "flac":
+        command += ["-codec:a", "flac", "-f", "flac"]
+    else:
+        raise TranscoderException(f"Unsupported format {format}")
+    partial_target = f"{target}.part"
+    command.append(partial_target)
+    try:
+        with tracer.span("transcode", target_format=get_format_label(format, bitrate)):
+            subprocess.run(command, check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        if os.path.exists(partial_target):
+            os.remove(partial_target)
+        raise TranscoderException(e.stderr.decode(errors="replace").strip())
+    os.replace(partial_target, target)
+    return target
+
+
+class Transcoder:
+    """
+    Encodes downloaded tracks to other formats locally. Each encoding runs in its own single threaded ffmpeg process,
+    and up to `max_workers` of them run at once.
+    """
+
+    def __init__(self, max_workers=None):
+        if shutil.which("ffmpeg") is None:
+            raise TranscoderException("ffmpeg is required for transcoding, but it could not be found in PATH")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(), thread_name_prefix="transcoder")
+
+    def submit(self, source, target, format, bitrate=None):
+        if os.path.exists(target):
+            logger.info(f"Skipping transcoding, since '{target}' already exists")
+            return self.executor.submit(lambda: target)
+        target_dir = os.path.dirname(target)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir, exist_ok=True)
+        logger.debug(f"Transcoding '{os.path.basename(source)}' to {get_format_label(format, bitrate)}")
+        return self.executor.submit(transcode, source, target, format, bitrate)
+
+    def close(self):
+        self.executor.shutdown(wait=True)